@@ -1,8 +1,11 @@
+import asyncio
 import concurrent.futures
+import mmap
 import os
+import struct
 import subprocess
 import sys
-from collections import deque
+import time
 
 import click
 import rich
@@ -14,74 +17,290 @@ from rich.prompt import Prompt
 
 
 class Utils:
+    SCAN_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+    COPY_BUFFER_SIZE = 1 << 20  # bytes, used when the kernel cannot copy files by itself
+
+    # ffmpeg only reports errors, so what it writes to stderr stays tiny even for long encodes, and it never reads the
+    # terminal, which concurrent ffmpegs would otherwise fight over
+    FFMPEG_ARGS = ("ffmpeg", "-nostdin", "-y", "-hide_banner", "-nostats", "-loglevel", "error")
+
     @staticmethod
-    def escape_separators(s: str) -> str:
-        return s.replace("\\", "\\\\").replace("|", "\\|")
+    def split_file_name(path) -> (str, str | None):
+        """
+        Splits the name of a file into its stem and its extension in a single scan.
+
+        Parameters:
+            path (str): The path or the name of the file.
+
+        Returns:
+            The stem and the lowercase extension without its dot, None if the file has no extension.
+        """
+        name = os.path.basename(path)
+        dot = name.rfind(".")
+        if 0 < dot < len(name) - 1:
+            return name[:dot], name[dot + 1:].lower()
+        return name, None
 
     @staticmethod
-    def unescape_separators(s: str) -> str:
-        return s.replace("\\\\", "\\").replace("\\|", "|")
+    def threads_per_invocation(n_workers: int) -> int:
+        """
+        Splits the CPUs between concurrent ffmpeg invocations, so that together they use every core
+        without oversubscribing them.
+
+        Parameters:
+            n_workers (int): The number of ffmpeg invocations running at once.
+
+        Returns:
+            The number of threads each ffmpeg may use, at least 1.
+        """
+        return max(1, (os.cpu_count() or n_workers) // n_workers)
 
     @staticmethod
-    def get_file_name(path) -> str:
-        return os.path.splitext(os.path.basename(path))[0]
+    def scan_dir(dir_path: str, recursive: bool) -> ([os.DirEntry], [os.DirEntry]):
+        """
+        Lists a single directory, relying on the file type cached by `os.scandir` instead of stat-ing every entry.
+
+        Parameters:
+            dir_path (str): The directory to scan.
+            recursive (bool): Flag indicating whether subdirectories should be reported.
+
+        Returns:
+            A tuple of the files and the subdirectories found in `dir_path`.
+        """
+        files = []
+        subdirs = []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_file():
+                    files.append(entry)
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry)
+        return files, subdirs
 
     @staticmethod
-    def get_file_ext(path) -> str | None:
-        ext = os.path.splitext(os.path.basename(path))[1]
-        return None if len(ext) < 2 else ext[1:]
+    def walk(dir_path: str, recursive: bool):
+        """
+        Yields the files found under the given directory, one directory at a time. Directories are scanned
+        concurrently by a thread pool so that the latency of each scan (high on network filesystems) overlaps
+        with the others, while the caller consumes the files from a single thread.
+
+        Parameters:
+            dir_path (str): The directory to walk.
+            recursive (bool): Flag indicating whether to descend into subdirectories.
+
+        Returns:
+            A generator of (relative_path, [os.DirEntry]) tuples, one per directory, relative_path being the path
+            of the directory relative to `dir_path`, ending with a separator, and the list holding its files.
+            Directories are not yielded in any particular order.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=Utils.SCAN_MAX_WORKERS) as executor:
+            pending = {executor.submit(Utils.scan_dir, dir_path, recursive): ""}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    relative_path = pending.pop(future)
+                    files, subdirs = future.result()
+                    for subdir in subdirs:
+                        sub_relative_path = relative_path + subdir.name + os.sep
+                        pending[executor.submit(Utils.scan_dir, subdir.path, recursive)] = sub_relative_path
+                    yield relative_path, files
 
     @staticmethod
     def create_file_if_not_exists(path: str):
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)  # no separate exists probe
 
     @staticmethod
-    def rekonv_file(target_path: str, output_path: str, idx=1, ttl=1):
+    async def rekonv_file(target_path: str, output_path: str, idx=1, ttl=1, threads=1):
         """
         Convert a single audio file from the given target path to the specified output path using ffmpeg.
+        ffmpeg is spawned directly from the event loop, so running many conversions at once only costs
+        one ffmpeg process each.
 
         Parameters:
             target_path (str): The path of the input audio file.
             output_path (str): The path of the output audio file.
+            threads (int): The number of threads ffmpeg may use to decode and to encode.
 
         Returns:
-            None
+            [(str, str, str)]: The (input path, output path, ffmpeg's error output) of the conversion if it failed,
+            nothing otherwise.
         """
         print(f"[magenta]converting file {output_path}, [{idx}/{ttl}]")
-        Utils.create_file_if_not_exists(output_path)
-        ffmpeg_subprocess = subprocess.run(["ffmpeg", "-y", "-i", target_path, output_path], capture_output=True)
-        if ffmpeg_subprocess.returncode != 0 or not os.path.exists(output_path):
-            print(f"[red]Failed to convert {target_path} to {output_path}, ffmpeg returned \n\t{t.stderr}")
+        threads = str(threads)
+        ffmpeg_subprocess = await asyncio.create_subprocess_exec(*Utils.FFMPEG_ARGS, "-threads", threads,
+                                                                 "-i", target_path, "-threads", threads, output_path,
+                                                                 stdout=asyncio.subprocess.DEVNULL,
+                                                                 stderr=asyncio.subprocess.PIPE)
+        _, stderr = await ffmpeg_subprocess.communicate()
+        if ffmpeg_subprocess.returncode != 0:  # with -y, a zero return code means the output was written
+            return [(target_path, output_path, stderr.decode(errors='replace'))]
+        return []
+
+    @staticmethod
+    async def rekonv_files(files: [(str, str)], idx=1, ttl=1, threads=1):
+        """
+        Convert several audio files with a single ffmpeg process, so that ffmpeg's startup is paid once for
+        the whole batch, each output getting the first audio stream, the metadata and the chapters of its input
+        (ffmpeg would otherwise give every output those of the first input). If ffmpeg fails, the files
+        are converted again one by one so that only the faulty ones are reported.
+
+        Parameters:
+            files ([(str, str)]): The (input path, output path) pairs to convert.
+            idx (int): The number of the first conversion, for display.
+            ttl (int): The total number of conversions, for display.
+            threads (int): The number of threads ffmpeg may use for each decoder and each encoder.
+
+        Returns:
+            [(str, str, str)]: The (input path, output path, ffmpeg's error output) of the conversions that failed.
+        """
+        args = list(Utils.FFMPEG_ARGS)
+        for target_path, _ in files:
+            args += ["-threads", str(threads), "-i", target_path]
+        for i, (_, output_path) in enumerate(files):
+            print(f"[magenta]converting file {output_path}, [{idx + i}/{ttl}]")
+            args += ["-map", f"{i}:a:0", "-map_metadata", str(i), "-map_chapters", str(i),
+                     "-threads", str(threads), output_path]
+        ffmpeg_subprocess = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL,
+                                                                 stderr=asyncio.subprocess.DEVNULL)
+        if await ffmpeg_subprocess.wait() == 0:
+            return []
+        errors = []
+        for i, (target_path, output_path) in enumerate(files):
+            errors += await Utils.rekonv_file(target_path, output_path, idx + i, ttl, threads)
+        return errors
+
+    @staticmethod
+    def fast_copy(target_path: str, output_path: str):
+        """
+        Copy a file with `os.copy_file_range`, which moves the data inside the kernel (or reflinks it on
+        filesystems supporting it), falling back to `os.sendfile`, still in the kernel, then to a buffered copy.
+        The permission bits are copied as well, like `shutil.copy` does.
+
+        Parameters:
+            target_path (str): The path of the input file.
+            output_path (str): The path of the output file.
+
+        Raises:
+            shutil.SameFileError: If both paths are the same file, which opening the output would truncate.
+
+        Returns:
+            None
+        """
+        try:
+            if os.path.samefile(target_path, output_path):
+                raise shutil.SameFileError(f"{target_path} and {output_path} are the same file")
+        except FileNotFoundError:  # the output does not exist yet
+            pass
+        with open(target_path, "rb") as target_fd, open(output_path, "wb") as output_fd:
+            src, dst = target_fd.fileno(), output_fd.fileno()
+            try:
+                while os.copy_file_range(src, dst, sys.maxsize):
+                    pass
+            except (AttributeError, OSError):  # not on Linux, or not supported between these filesystems
+                try:
+                    while os.sendfile(dst, src, None, sys.maxsize):
+                        pass
+                # outside of Linux, sendfile only writes to sockets and needs an explicit offset (TypeError on None)
+                except (AttributeError, OSError, TypeError):
+                    # the calls above moved both file offsets, so this carries on from where they stopped
+                    shutil.copyfileobj(target_fd, output_fd, Utils.COPY_BUFFER_SIZE)
+        shutil.copymode(target_path, output_path)
+
+    @staticmethod
+    async def copy_file(target_path: str, output_path: str):
+        """
+        Copy a single file from the given target path to the specified output path, in a worker thread
+        so that the event loop keeps driving the running conversions.
+
+        Parameters:
+            target_path (str): The path of the input file.
+            output_path (str): The path of the output file.
+
+        Returns:
+            None
+        """
+        print(f"[magenta]copying file {output_path}")
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, Utils.fast_copy, target_path, output_path)
+        except shutil.SameFileError:
+            print(f"[yellow]skipping {target_path}, it is already its own copy")
 
 
 class Rekonv:
-    INPUT_FORMATS = [
-        "aiff", "aif", "au", "flac", "m4a", "mp3", "ogg", "wav", "webm", "aac",  # audio formats
-        "flv", "ogv", "mov", "mp4", "m4v", "mpg", "mpeg", "mp2", "mpe", "m2v",  # video formats
-    ]
+    AUDIO_FORMATS = frozenset(("aiff", "aif", "au", "flac", "m4a", "mp3", "ogg", "wav", "webm", "aac"))
+
+    VIDEO_FORMATS = frozenset(("flv", "ogv", "mov", "mp4", "m4v", "mpg", "mpeg", "mp2", "mpe", "m2v"))
+
+    INPUT_FORMATS = AUDIO_FORMATS | VIDEO_FORMATS
+
+    # Output formats whose muxer has no default video stream: for audio inputs, mapping the first audio stream
+    # of each input to its output, along with that input's metadata and chapters, is what ffmpeg would pick on its
+    # own, so several files can share a process
+    BATCH_OUTPUT_FORMATS = frozenset(("aac", "wav"))
+
+    CONVERT_BATCH_SIZE = 32
 
-    OUTPUT_FORMATS = ["aiff", "mp3", "aac", "flac", "wav"]
+    REFRESH_INTERVAL = 0.1  # seconds between two renders of the progress bars
 
-    CREATE_INDEX_FLUSH_BUFFER = 1000
+    CHECKPOINT_INTERVAL = 16  # files completed between two saves of the index position, at most redone on resume
 
-    INDEX_PATH = os.path.abspath("./.index.rk")
+    OUTPUT_FORMATS = ("aiff", "mp3", "aac", "flac", "wav")
 
-    INDEX_POS_PATH = os.path.abspath("./.index-pos.rk")
+    CREATE_INDEX_FLUSH_SIZE = 1 << 20  # bytes
 
-    def __init__(self, single_process, max_concurrent_conversions, f_done=0, c_done=0):
+    INDEX_PATH = ".index.rk"  # relative to the working directory, see index_path()
+
+    INDEX_POS_PATH = ".index-pos.rk"  # relative to the working directory, see index_pos_path()
+
+    INDEX_HEADER = struct.Struct("<QQ")  # (num_files, num_to_convert)
+
+    INDEX_ENTRY = struct.Struct("<IIB")  # (input_len, output_len, convert), followed by both encoded paths
+
+    INDEX_POS = struct.Struct("<QQQ")  # (files_done, conv_done, byte offset of the next entry to process)
+
+    @classmethod
+    def index_path(cls) -> str:
+        """
+        Resolves the index path against the current working directory when it is needed rather than at import.
+
+        :return: The absolute path of the index file.
+        :rtype: str
+        """
+        return os.path.abspath(cls.INDEX_PATH)
+
+    @classmethod
+    def index_pos_path(cls) -> str:
+        """
+        Resolves the index position path against the current working directory when it is needed rather than at
+        import.
+
+        :return: The absolute path of the index position file.
+        :rtype: str
+        """
+        return os.path.abspath(cls.INDEX_POS_PATH)
+
+    def __init__(self, single_process, max_concurrent_conversions, f_done=0, c_done=0, offset=None, ffmpeg_threads=0,
+                 verify=False):
         self.FILE_DONE = f_done
         self.CONV_DONE = c_done
-        self.max_concurrent_conversions = 0 if single_process \
-            else max_concurrent_conversions if max_concurrent_conversions > 0 else os.cpu_count()
-        self.futures = []
-        self.single_process = single_process
-
-    def handle_future_termination(self, all_files_task, conversion_task, progress):
+        self.offset = Rekonv.INDEX_HEADER.size if offset is None else offset
+        self.position = (f_done, c_done, self.offset)
+        self.max_concurrent_conversions = 1 if single_process \
+            else max_concurrent_conversions if max_concurrent_conversions > 0 else os.cpu_count() or 1
+        self.futures = {}  # task -> (index position of its first entry, number of files, number of conversions)
+        self.ffmpeg_threads = ffmpeg_threads  # 0 shares the CPUs between the concurrent ffmpeg invocations
+        self.verify = verify  # check that every output exists once done, on top of ffmpeg's return codes
+        self.errors = []  # (input path, output path, ffmpeg's error output) of the conversions that failed
+        self.unsaved_files = 0  # files completed since the index position was last saved
+
+    def handle_future_termination(self, tasks_done, all_files_task, conversion_task, progress):
         """
-        Updates the progress bar and removes completed tasks from the list of futures.
+        Updates the progress bar, removes completed tasks from the running futures, records the conversions
+        they failed and saves the new position every `CHECKPOINT_INTERVAL` files.
 
         Parameters:
+            tasks_done (set): The completed tasks, as returned by `asyncio.wait`.
             all_files_task (int): The task ID for the "All files" progress bar.
             conversion_task (int): The task ID for the "Files to convert" progress bar.
             progress (rich.progress.Progress): The progress bar object.
@@ -89,13 +308,24 @@ class Rekonv:
         Returns:
             None
         """
-        tasks_done = filter(lambda x: x.done(), self.futures)
+        files_done = 0
+        conv_done = 0
         for task in tasks_done:
-            self.FILE_DONE += 1
-            self.CONV_DONE += 1
-            progress.update(all_files_task, advance=1)
-            progress.update(conversion_task, advance=1)
-            self.futures.remove(task)
+            _, files, conversions = self.futures.pop(task)
+            failed = task.result()  # propagates a failed copy
+            if failed:
+                self.errors += failed
+            files_done += files
+            conv_done += conversions
+        # a single update per progress bar, however many tasks completed
+        self.FILE_DONE += files_done
+        self.CONV_DONE += conv_done
+        progress.update(all_files_task, advance=files_done)
+        progress.update(conversion_task, advance=conv_done)
+        self.unsaved_files += files_done
+        if self.unsaved_files >= Rekonv.CHECKPOINT_INTERVAL:
+            self.save_index_position()  # so that even a killed run can be resumed from about here
+            self.unsaved_files = 0
 
 
     def delete_index(self):
@@ -109,55 +339,67 @@ class Rekonv:
         Returns:
             None
         """
-        if os.path.exists(self.INDEX_PATH):
-            os.remove(self.INDEX_PATH)
-        if os.path.exists(self.INDEX_POS_PATH):
-            os.remove(self.INDEX_POS_PATH)
+        if os.path.exists(self.index_path()):
+            os.remove(self.index_path())
+        if os.path.exists(self.index_pos_path()):
+            os.remove(self.index_pos_path())
 
-    def check_with_index(self) -> None:
+    def check_with_index(self, end=None) -> None:
         """
         Check the index file for errors and report any missing files.
 
         This function checks if the index file exists and raises an exception if it does not.
-        It then reads the index file line by line and checks if each entry is valid.
+        It then reads the index file entry by entry and checks if each converted file exists.
         Finally, if there are any errors, they are reported to the console.
 
+        Parameters:
+            end (int): The byte offset of the first entry not to check, by default the whole index is checked.
+
         Returns:
             None
         """
-        if not os.path.exists(self.INDEX_PATH):
+        if not os.path.exists(self.index_path()):
             raise Exception("Index file not found")
         errors = []
         try:
-            with open(self.INDEX_PATH, "r") as ifd:
-                num_files, num_to_convert = Rekonv.get_index_headers(ifd)
-                for i in range(num_files):
-                    entry_raw = ifd.readline()
-                    if not entry_raw:
+            with open(self.index_path(), "rb") as ifd, mmap.mmap(ifd.fileno(), 0, access=mmap.ACCESS_READ) as imm:
+                for offset, input_file, output_file, _ in Rekonv.read_index(imm):
+                    if end is not None and offset >= end:
                         break
-                    entry: IndexEntry = tuple(entry_raw.split("||"))
-                    if len(entry) != 3:
-                        raise Exception("Invalid index entry")
-                    if not os.path.exists(Utils.unescape_separators(entry[1])):
-                        errors.append(entry)
+                    if not os.path.exists(output_file):
+                        errors.append((input_file, output_file))
             if errors:
                 for error in errors:
                     print(f"[red] file {error[0]} was not found at path {error[1]}")
         except FileNotFoundError:
             print("[red]Error while checking index file")
-        finally:
-            ifd.close()
+
+    @staticmethod
+    def report_errors(errors: [(str, str, str)]) -> None:
+        """
+        Prints the conversions that failed along with what ffmpeg said about them.
+
+        :param errors: The (input path, output path, ffmpeg's error output) of the failed conversions.
+        """
+        for input_file, output_file, message in errors:
+            print(f"[red]Failed to convert {input_file} to {output_file}, ffmpeg returned \n\t{message}")
 
     def rekonv_batch(self) -> None:
         """
-        Executes a batch conversion of files by calling the `work_from_index` function,
-        `check_with_index` function, and `delete_index` function in sequence.
+        Executes a batch conversion of files by calling the `work_from_index` function, reporting the failed
+        conversions, then calling the `check_with_index` function if `verify` is set, and the `delete_index` function.
+        A resumed run always checks the entries done before it, as their failures were only known to the
+        interrupted run.
 
         Returns:
             None
         """
         self.work_from_index()
-        self.check_with_index()
+        Rekonv.report_errors(self.errors)
+        if self.verify:
+            self.check_with_index()
+        elif self.offset > Rekonv.INDEX_HEADER.size:
+            self.check_with_index(self.offset)
         self.delete_index()
 
     def rekonv(self, target: str, output_fd: str, output_format: str, single_file: bool, skip_existing_files: bool,
@@ -187,7 +429,9 @@ class Rekonv:
         After the conversion is done, it prints "Done!" to the console.
         """
         if single_file:
-            Utils.rekonv_file(target, output_fd)
+            Utils.create_file_if_not_exists(output_fd)
+            threads = self.ffmpeg_threads or Utils.threads_per_invocation(1)
+            Rekonv.report_errors(asyncio.run(Utils.rekonv_file(target, output_fd, threads=threads)))
         else:
             self.create_index(target, output_fd, output_format, skip_existing_files, recursive, copy_all_files)
             self.rekonv_batch()
@@ -197,9 +441,8 @@ class Rekonv:
                      copy_all_files: bool):
         """
         Create an index of files to be converted from the given target directory.
-        The index is stored in a temporary file and then appended to the main index file.
-        The main index file contains the number of files and the number of files
-        to be converted.
+        The index is written in a single pass, its headers, the number of files and the number of files
+        to be converted, being patched in place once the walk is done.
 
         Parameters:
             target (str): The target directory to create the index from.
@@ -213,152 +456,251 @@ class Rekonv:
         Returns:
             None
         """
-        index: [IndexEntry] = []
-        entries_til_last_flush = 0
+        index = bytearray()
+        output_dirs = []  # output directories that will receive files
+        dot_ext = "." + output_format
         num_files = 0
         num_to_convert = 0
         output_fd = os.path.abspath(output_fd)
         target = os.path.abspath(target)
-        queue = deque([(target, '')])  # Store both the directory path and its relative path from target
-        temp_file_path = "temp_index_file"
+        # the index files live in the working directory, which may be the walked one
+        index_files = {self.index_path(), self.index_pos_path(), self.index_pos_path() + ".tmp"}
 
-        # Step 1: Create a temporary file to store the actual data
         try:
-            with open(temp_file_path, "w") as temp_fd:
-                while queue:
-                    current_dir, relative_path = queue.popleft()
-                    for entry in os.scandir(current_dir):
-                        if entry.is_file():
-                            file = os.path.abspath(entry.path)
-                            file_name = Utils.get_file_name(file)
-                            file_ext = Utils.get_file_ext(file)
-                            # Construct the output file path based on the relative path from the target
-                            output_file_path = os.path.join(output_fd, relative_path, f"{file_name}.{output_format}")
-                            output_file = os.path.abspath(output_file_path)
-                            if skip_existing_files and os.path.exists(output_file):  # check if file exists
-                                # if skip_existing_files is set to true
+            # a position saved against a previous index would point at misaligned entries of this one
+            for pos_path in (self.index_pos_path(), self.index_pos_path() + ".tmp"):
+                if os.path.exists(pos_path):
+                    os.remove(pos_path)
+            with open(self.index_path(), "wb", buffering=Rekonv.CREATE_INDEX_FLUSH_SIZE) as index_fd:
+                # Reserve the headers, they are patched in place once the number of files is known
+                index_fd.write(Rekonv.INDEX_HEADER.pack(0, 0))
+                try:
+                    for relative_path, entries in Utils.walk(target, recursive):
+                        # Construct the output directory path based on the relative path from the target once for
+                        # all its files, output_fd being absolute already; it ends with a separator
+                        out_dir = os.path.join(output_fd, relative_path)
+                        listing = ()
+                        if skip_existing_files:
+                            # one listing per output directory instead of a stat per file
+                            try:
+                                listing = set(os.listdir(out_dir))
+                            except (FileNotFoundError, NotADirectoryError):
+                                pass
+                        dir_num_files = num_files
+                        for entry in entries:
+                            file = entry.path  # already absolute as target is
+                            if file in index_files:
+                                continue
+                            # entry.name is already the basename, a single inline rfind splits it without a call
+                            # per file (see split_file_name)
+                            dot = entry.name.rfind(".")
+                            if 0 < dot < len(entry.name) - 1:
+                                file_name, file_ext = entry.name[:dot], entry.name[dot + 1:].lower()
+                            else:
+                                file_name, file_ext = entry.name, None
+                            output_name = file_name + dot_ext
+                            if output_name in listing:
                                 continue
-                            file = Utils.escape_separators(file)  # avoid separators in paths
-                            output_file = Utils.escape_separators(output_file)
                             if file_ext in Rekonv.INPUT_FORMATS:
-                                index.append(f"{file}||{output_file}||1")
-                                entries_til_last_flush += 1
+                                index += Rekonv.pack_index_entry(file, out_dir + output_name, True)
                                 num_files += 1
                                 num_to_convert += 1
-                            else:
-                                if copy_all_files:
-                                    correct_output_name = f"{file_name}.{file_ext}" if file_ext else file_name
-                                    new_file_path = os.path.join(output_fd, relative_path, correct_output_name)
-                                    index.append(f"{file}||{new_file_path}||0")
-                                    entries_til_last_flush += 1
-                                    num_files += 1
-                            if entries_til_last_flush >= Rekonv.CREATE_INDEX_FLUSH_BUFFER:
-                                buffer = "\n".join(index) + "\n"
-                                temp_fd.write(buffer)
+                            elif copy_all_files:
+                                index += Rekonv.pack_index_entry(file, out_dir + entry.name, False)
+                                num_files += 1
+                            if len(index) >= Rekonv.CREATE_INDEX_FLUSH_SIZE:
+                                index_fd.write(index)
                                 index.clear()
-                                entries_til_last_flush = 0
-                        elif entry.is_dir() and recursive:
-                            # Append the directory path and its relative path from target to the queue
-                            queue.append((entry.path, os.path.join(relative_path, entry.name)))
-                if index:  # index array is not empty
-                    buffer = "\n".join(index)
-                    temp_fd.write(buffer)
-        except Exception as ex:
-            print(ex)
-        finally:
-            temp_fd.close()
-        # Step 2: Write headers to the index file
-        try:
-            with open(self.INDEX_PATH, "w") as index_fd:
-                index_fd.write(f"{num_files}, {num_to_convert}\n")
-        except Exception as ex:
-            print(f"Error writing headers to index file: {ex}")
-        finally:
-            index_fd.close()
-
-        # Step 3: Append the temporary file to the index file
-        try:
-            with open(temp_file_path, "r") as temp_fd, open(self.INDEX_PATH, "a") as index_fd:
-                index_fd.write(temp_fd.read())
+                        if num_files > dir_num_files:
+                            output_dirs.append(out_dir)
+                except Exception as ex:
+                    print(ex)
+                index_fd.write(index)
+                index_fd.seek(0)
+                index_fd.write(Rekonv.INDEX_HEADER.pack(num_files, num_to_convert))
+            # Create every output directory once now rather than checking for it before each conversion
+            for out_dir in output_dirs:
+                os.makedirs(out_dir, exist_ok=True)
         except Exception as ex:
             print(f"Error creating index {ex}")
 
-        # Clean up the temporary file
-        os.remove(temp_file_path)
+    @staticmethod
+    def can_batch(input_file: str, output_file: str) -> bool:
+        """
+        Tells whether the conversion of `input_file` to `output_file` can share an ffmpeg process with others
+        without changing which streams end up in the output.
+
+        :param input_file: The path of the input file.
+        :param output_file: The path of the output file.
+
+        :return: True if the conversion can be batched.
+        :rtype: bool
+        """
+        return (Utils.split_file_name(output_file)[1] in Rekonv.BATCH_OUTPUT_FORMATS
+                and Utils.split_file_name(input_file)[1] in Rekonv.AUDIO_FORMATS)
+
+    @staticmethod
+    def pack_index_entry(input_file: str, output_file: str, convert: bool) -> bytes:
+        """
+        Packs an index entry as a fixed-size record header followed by both paths, encoded with the
+        filesystem encoding so that no separator escaping is needed.
+
+        :param input_file: The path of the input file.
+        :param output_file: The path of the output file.
+        :param convert: Whether the file has to be converted or only copied.
+
+        :return: The packed entry.
+        :rtype: bytes
+        """
+        input_bytes = os.fsencode(input_file)
+        output_bytes = os.fsencode(output_file)
+        return Rekonv.INDEX_ENTRY.pack(len(input_bytes), len(output_bytes), int(convert)) + input_bytes + output_bytes
+
+    @staticmethod
+    def read_index(index_mm, offset=None):
+        """
+        Iterates over the entries of a memory-mapped index, starting at the given byte offset.
+
+        :param index_mm: The memory-mapped index file.
+        :param offset: The byte offset of the first entry to read, by default right after the headers.
+
+        :return: A generator of (offset, input_path, output_path, convert) tuples.
+        :rtype: generator
+        """
+        offset = Rekonv.INDEX_HEADER.size if offset is None else offset
+        end = len(index_mm)
+        while offset < end:
+            input_len, output_len, convert = Rekonv.INDEX_ENTRY.unpack_from(index_mm, offset)
+            input_start = offset + Rekonv.INDEX_ENTRY.size
+            output_start = input_start + input_len
+            next_offset = output_start + output_len
+            if next_offset > end:
+                raise Exception("Invalid index entry")
+            yield (offset, os.fsdecode(index_mm[input_start:output_start]),
+                   os.fsdecode(index_mm[output_start:next_offset]), convert == 1)
+            offset = next_offset
 
     @staticmethod
-    def get_index_headers(index_fd) -> (int, int):
+    def get_index_headers(index_mm) -> (int, int):
         """
-        Reads the first line of the given file object `index_fd` and splits it by comma.
-        Parses the resulting list into two integers representing the headers of the index.
+        Unpacks the headers stored at the beginning of the given memory-mapped index.
 
-        :param index_fd: A file object to read the first line from.
-        :type index_fd: file object
+        :param index_mm: The memory-mapped index file.
+        :type index_mm: mmap.mmap
 
         :return: A tuple of two integers representing the headers of the index.
         :rtype: tuple(int, int)
         """
-        headers = index_fd.readline().split(",")
-        return int(headers[0]), int(headers[1])
+        return Rekonv.INDEX_HEADER.unpack_from(index_mm)
+
+    @staticmethod
+    def get_index_position() -> (int, int, int):
+        """
+        Reads the position saved in the index position file when a conversion was interrupted.
+
+        :return: A tuple of the number of files done, the number of conversions done and the byte offset
+         of the next entry to process.
+        :rtype: tuple(int, int, int)
+        """
+        with open(Rekonv.index_pos_path(), "rb") as pos_fd:
+            return Rekonv.INDEX_POS.unpack(pos_fd.read(Rekonv.INDEX_POS.size))
+
+    def save_index_position(self):
+        """
+        Saves the position of the oldest entry that is not done yet to the index position file,
+        so that a later run can seek directly to it. The file is written aside and then renamed over the
+        previous one, so a crash can never leave a truncated position behind.
+        """
+        files_done, conv_done, offset = min((*(position for position, _, _ in self.futures.values()), self.position))
+        pos_path = Rekonv.index_pos_path()
+        with open(pos_path + ".tmp", "wb") as pos_fd:
+            pos_fd.write(Rekonv.INDEX_POS.pack(files_done, conv_done, offset))
+        os.replace(pos_path + ".tmp", pos_path)
 
     def work_from_index(self):
         """
         A function that processes the index file, handles file conversions, and updates progress.
         """
         try:
-            with open(Rekonv.INDEX_PATH, "r") as index_fd:
-                num_files, num_to_convert = Rekonv.get_index_headers(index_fd)
-                start_files = self.FILE_DONE
-                start_convert = self.CONV_DONE
-
-                progress = Progress(auto_refresh=False)
-
-                all_files_task = progress.add_task("[yellow]All files...", total=num_files, completed=start_files)
-                conversion_task = progress.add_task("[yellow]Files to convert...", total=num_to_convert,
-                                                    completed=start_convert)
-                with Live(progress, auto_refresh=False) as live, concurrent.futures.ProcessPoolExecutor() as executor:
-                    for i in range(0, start_files, 1):
-                        index_entry = index_fd.readline().split("||")
-                        output_file = Utils.unescape_separators(index_entry[1])
-                        print(f"[yellow]skipping file {output_file}")
-                    for i in range(start_files, num_files, 1):
-                        index_entry = index_fd.readline().split("||")
-                        input_file = Utils.unescape_separators(index_entry[0])
-                        # replace separators if present in
-                        output_file = Utils.unescape_separators(index_entry[1])
-                        convert = int(index_entry[2]) == 1
-
-                        if convert:
-                            if self.single_process:
-                                Utils.rekonv_file(input_file, output_file, i, num_to_convert)
-                                self.CONV_DONE += 1
-                                self.FILE_DONE += 1
-                                progress.update(all_files_task, advance=1)
-                                progress.update(conversion_task, advance=1)
-                            else:
-                                self.futures.append(executor.submit(Utils.rekonv_file, input_file, output_file, i, num_to_convert))
-
-                        else:
-                            print(f"[magenta]copying file {output_file}")
-                            Utils.create_file_if_not_exists(output_file)
-                            progress.update(all_files_task, advance=1)
-                            shutil.copy(input_file, output_file)
-                            self.FILE_DONE += 1
-                        while not self.single_process and len(self.futures) > self.max_concurrent_conversions:
-                            self.handle_future_termination(all_files_task, conversion_task, progress)
-                            live.refresh()
-                    while not self.single_process and len(self.futures) > 0:
-                        self.handle_future_termination(all_files_task, conversion_task, progress)
-                        live.refresh()
+            asyncio.run(self.work_from_index_async())
         except KeyboardInterrupt:
             print(f"Interrupted at {self.FILE_DONE} files and {self.CONV_DONE} conversions, saving position.")
-            index_fd.close()
-            with open(Rekonv.INDEX_POS_PATH, "w") as ifd:
-                ifd.write(f"{self.FILE_DONE},{self.CONV_DONE}")
+            self.save_index_position()
             raise KeyboardInterrupt()
         except Exception as ex:
             print(f"Error: {ex}")
 
+    async def work_from_index_async(self):
+        """
+        Reads the index entries one by one and runs their conversion or copy as asyncio tasks,
+        keeping at most `max_concurrent_conversions` of them running at once. Consecutive conversions
+        that can share an ffmpeg process are grouped in batches of up to `CONVERT_BATCH_SIZE` files.
+        """
+        with open(Rekonv.index_path(), "rb") as index_fd, \
+                mmap.mmap(index_fd.fileno(), 0, access=mmap.ACCESS_READ) as index_mm:
+            num_files, num_to_convert = Rekonv.get_index_headers(index_mm)
+            file_idx = self.FILE_DONE
+            conv_idx = self.CONV_DONE
+            batch = []  # (input_path, output_path) pairs waiting to be converted by a single ffmpeg
+            threads = self.ffmpeg_threads or Utils.threads_per_invocation(self.max_concurrent_conversions)
+
+            progress = Progress(auto_refresh=False)
+
+            all_files_task = progress.add_task("[yellow]All files...", total=num_files, completed=file_idx)
+            conversion_task = progress.add_task("[yellow]Files to convert...", total=num_to_convert,
+                                                completed=conv_idx)
+            last_refresh = 0.0
+
+            def refresh():
+                # rendering costs more than the progress updates themselves, so it is done at most every
+                # REFRESH_INTERVAL, the last render happening when the Live display stops
+                nonlocal last_refresh
+                now = time.monotonic()
+                if now - last_refresh >= Rekonv.REFRESH_INTERVAL:
+                    live.refresh()
+                    last_refresh = now
+
+            async def submit(coroutine, files, conversions):
+                # self.position is the one of the first entry handled by the task
+                self.futures[asyncio.create_task(coroutine)] = (self.position, files, conversions)
+                while len(self.futures) >= self.max_concurrent_conversions:
+                    done, _ = await asyncio.wait(self.futures, return_when=asyncio.FIRST_COMPLETED)
+                    self.handle_future_termination(done, all_files_task, conversion_task, progress)
+                    refresh()
+
+            async def submit_batch():
+                await submit(Utils.rekonv_files(batch.copy(), self.position[1] + 1, num_to_convert, threads),
+                             len(batch), len(batch))
+                batch.clear()
+
+            if file_idx > 0:
+                print(f"[yellow]skipping {file_idx} files already processed")
+            with Live(progress, auto_refresh=False) as live:
+                for offset, input_file, output_file, convert in Rekonv.read_index(index_mm, self.offset):
+                    batchable = convert and Rekonv.can_batch(input_file, output_file)
+                    if batch and not batchable:
+                        await submit_batch()
+                    if not batch:
+                        self.position = (file_idx, conv_idx, offset)
+                    if batchable:
+                        batch.append((input_file, output_file))
+                        if len(batch) >= Rekonv.CONVERT_BATCH_SIZE:
+                            await submit_batch()
+                    elif convert:
+                        await submit(Utils.rekonv_file(input_file, output_file, conv_idx + 1, num_to_convert, threads),
+                                     1, 1)
+                    else:
+                        await submit(Utils.copy_file(input_file, output_file), 1, 0)
+                    file_idx += 1
+                    conv_idx += convert
+                if batch:
+                    await submit_batch()
+                self.position = (file_idx, conv_idx, len(index_mm))
+                while len(self.futures) > 0:
+                    done, _ = await asyncio.wait(self.futures, return_when=asyncio.FIRST_COMPLETED)
+                    self.handle_future_termination(done, all_files_task, conversion_task, progress)
+                    refresh()
+
 
 IndexEntry = (str, str, bool)  # (input_path, output_path, tryConversion)
 HeaderEntry = (int, int)
@@ -367,7 +709,7 @@ HeaderEntry = (int, int)
 @click.command()
 @click.option("--target", "-t", default="./", help="target directory or file, by default \"./\"")
 @click.option("--output-fd", "-o", default="./", help="output directory")
-@click.option("--output-format", "-f", default="aac", type=click.Choice(["aiff", "mp3", "aac", "flac", "wav"]),
+@click.option("--output-format", "-f", default="aac", type=click.Choice(Rekonv.OUTPUT_FORMATS),
               help="output format")
 @click.option("--single-file", "-sf", is_flag=True, help="convert a single file, don't forget to set a target")
 @click.option("--skip-existing-files", "-skf", is_flag=True,
@@ -375,9 +717,14 @@ HeaderEntry = (int, int)
 @click.option("--recursive", "-r", is_flag=True, help="recursive")
 @click.option("--copy-all-files", "-cp", is_flag=True, help="copy all files even non musics")
 @click.option("--single-process", "-sp", is_flag=True, help="multiprocess")
-@click.option("--max-concurrent-processes", "-mcp", default=0, help="max concurrent processes")
+@click.option("--max-concurrent-processes", "--jobs", "-mcp", "-j", default=0,
+              help="max concurrent processes, by default the number of CPUs")
+@click.option("--ffmpeg-threads", default=0,
+              help="threads used by each ffmpeg, by default the CPUs are split between concurrent processes")
+@click.option("--verify", is_flag=True, help="check that every output file exists once done")
 def cli(target: str, output_fd: str, output_format: str, single_file: bool, skip_existing_files: bool, recursive: bool,
-        copy_all_files: bool, single_process: bool, max_concurrent_processes: int) -> None:
+        copy_all_files: bool, single_process: bool, max_concurrent_processes: int, ffmpeg_threads: int,
+        verify: bool) -> None:
     """
     A command-line interface function that converts audio files to a specified output format.
 
@@ -391,6 +738,8 @@ def cli(target: str, output_fd: str, output_format: str, single_file: bool, skip
         copy_all_files (bool): Flag indicating whether to copy all files, even non-music files. Default is False.
         single_process (bool): Flag indicating whether to run the conversion in a single process. Default is False.
         max_concurrent_processes (int): Number of max concurrent processes. Default is 0.
+        ffmpeg_threads (int): Number of threads used by each ffmpeg process. Default is 0.
+        verify (bool): Flag indicating whether to check every output file once done. Default is False.
 
     Raises:
         click.Abort: If the target is not set for single file conversion.
@@ -399,31 +748,28 @@ def cli(target: str, output_fd: str, output_format: str, single_file: bool, skip
         None
     """
 
-    index_path_exists = os.path.exists(Rekonv.INDEX_PATH)
-    index_pos_path_exists = os.path.exists(Rekonv.INDEX_POS_PATH)
+    index_path_exists = os.path.exists(Rekonv.index_path())
+    index_pos_path_exists = os.path.exists(Rekonv.index_pos_path())
 
     if index_path_exists and index_pos_path_exists:
         try:
-            with open(Rekonv.INDEX_POS_PATH, "r") as index_pos_file:
-                file_done, conv_done = Rekonv.get_index_headers(index_pos_file)
-                continue_prompt = True
-
-                while continue_prompt:
-                    response = Prompt.ask("[yellow]Do you want to continue from where you left off?",
-                                          choices=["y", "n"], show_choices=True)
-                    if response == "y":
-                        rekonv = Rekonv(single_process, max_concurrent_processes, file_done, conv_done)
-                        index_pos_file.close()
-                        rekonv.rekonv_batch()
-                        return
-                    elif response == "n":
-                        continue_prompt = False
-                    else:
-                        print("[red]Invalid input")
+            file_done, conv_done, offset = Rekonv.get_index_position()
+            continue_prompt = True
+
+            while continue_prompt:
+                response = Prompt.ask("[yellow]Do you want to continue from where you left off?",
+                                      choices=["y", "n"], show_choices=True)
+                if response == "y":
+                    rekonv = Rekonv(single_process, max_concurrent_processes, file_done, conv_done, offset,
+                                    ffmpeg_threads, verify)
+                    rekonv.rekonv_batch()
+                    return
+                elif response == "n":
+                    continue_prompt = False
+                else:
+                    print("[red]Invalid input")
         except Exception as ex:
             print(f"Error: {ex}")
-        finally:
-            index_pos_file.close()
 
     if single_file and target == "./":  # if for a single file, target needs to be set
         print("[red]target is mandatory for single file use")
@@ -440,10 +786,10 @@ def cli(target: str, output_fd: str, output_format: str, single_file: bool, skip
         output_fd = output_fd + "." + output_format
     elif single_file:
         target_path = os.path.abspath(target)  # absolute path to output target
-        target_name = Utils.get_file_name(target_path)  # name of the target obtained from absolute path
+        target_name, _ = Utils.split_file_name(target_path)  # name of the target obtained from absolute path
         target_dir = os.path.dirname(target_path)  # directory of the target
         output_fd = os.path.join(target_dir, target_name + "." + output_format)
-    rekonv = Rekonv(single_process, max_concurrent_processes, 0, 0)
+    rekonv = Rekonv(single_process, max_concurrent_processes, 0, 0, ffmpeg_threads=ffmpeg_threads, verify=verify)
     rekonv.rekonv(target, output_fd, output_format, single_file, skip_existing_files, recursive, copy_all_files)
 
 